@@ -2,13 +2,15 @@ import os
 import logging
 import re
 from datetime import datetime
-from typing import Optional, Dict, List
+from typing import Optional, Dict
 
 from aiogram import Bot, Dispatcher, types
 from aiogram.contrib.fsm_storage.memory import MemoryStorage
 from aiogram.dispatcher import FSMContext
 from aiogram.dispatcher.filters.state import State, StatesGroup
+from aiogram.dispatcher.webhook import SendMessage
 from aiogram.utils import executor
+from aiogram.utils.callback_data import CallbackData
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, ReplyKeyboardRemove
 
 from database import Database
@@ -21,6 +23,17 @@ load_dotenv()
 API_TOKEN = os.getenv('BOT_TOKEN')
 WEB_APP_URL = os.getenv('WEB_APP_URL', 'https://ваш-проект.railway.app')
 ADMIN_IDS = list(map(int, os.getenv('ADMIN_IDS', '').split(','))) if os.getenv('ADMIN_IDS') else []
+REDIS_URL = os.getenv('REDIS_URL')  # Общий кэш для нескольких воркеров (необязательно)
+
+# Webhook (если WEBHOOK_HOST не задан, бот работает через long polling)
+WEBHOOK_HOST = os.getenv('WEBHOOK_HOST')
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/webhook')
+WEBHOOK_URL = f"{WEBHOOK_HOST}{WEBHOOK_PATH}" if WEBHOOK_HOST else None
+WEBAPP_HOST = '0.0.0.0'
+WEBAPP_PORT = int(os.getenv('PORT', 8080))
+
+# Username бота (заполняется в on_startup)
+BOT_USERNAME = ""
 
 # Настройка логирования
 logging.basicConfig(
@@ -33,7 +46,20 @@ logger = logging.getLogger(__name__)
 bot = Bot(token=API_TOKEN)
 storage = MemoryStorage()
 dp = Dispatcher(bot, storage=storage)
-db = Database()
+db = Database(redis_url=REDIS_URL)
+
+# Команда репутации: «+rep @username комментарий» (комментарий необязателен)
+_REP_RE = re.compile(r'^([+-])(rep|реп)\s+(@?\w+|\d+)\s*(.*)$', re.IGNORECASE | re.DOTALL)
+
+# Навигация по отзывам: действие и индекс отзыва, который нужно показать
+rep_cb = CallbackData("rep", "action", "index")
+
+# Названия месяцев в родительном падеже
+RU_MONTHS = {
+    1: 'января', 2: 'февраля', 3: 'марта', 4: 'апреля',
+    5: 'мая', 6: 'июня', 7: 'июля', 8: 'августа',
+    9: 'сентября', 10: 'октября', 11: 'ноября', 12: 'декабря'
+}
 
 # ========== СОСТОЯНИЯ (FSM) ==========
 class ReputationStates(StatesGroup):
@@ -48,11 +74,7 @@ def format_profile(user_data: Dict, stats: Dict) -> str:
     
     # Форматирование даты
     created_at = datetime.strptime(user_data['created_at'], '%Y-%m-%d %H:%M:%S')
-    date_str = created_at.strftime('%d %B %Y').replace('January', 'января').replace('February', 'февраля')\
-        .replace('March', 'марта').replace('April', 'апреля').replace('May', 'мая')\
-        .replace('June', 'июня').replace('July', 'июля').replace('August', 'августа')\
-        .replace('September', 'сентября').replace('October', 'октября')\
-        .replace('November', 'ноября').replace('December', 'декабря')
+    date_str = f"{created_at.day:02d} {RU_MONTHS[created_at.month]} {created_at.year}"
     
     profile_text = f"""<blockquote>{username} (ID: {user_data['user_id']})
 
@@ -65,6 +87,22 @@ def format_profile(user_data: Dict, stats: Dict) -> str:
     
     return profile_text
 
+async def respond(message: types.Message, text: str, reply: bool = False, **kwargs) -> Optional[SendMessage]:
+    """Ответ на сообщение (в режиме webhook уходит в теле ответа на апдейт)"""
+    if WEBHOOK_HOST:
+        return SendMessage(
+            message.chat.id,
+            text,
+            reply_to_message_id=message.message_id if reply else None,
+            **kwargs
+        )
+    
+    if reply:
+        await message.reply(text, **kwargs)
+    else:
+        await message.answer(text, **kwargs)
+    return None
+
 def get_main_keyboard() -> types.ReplyKeyboardMarkup:
     """Главная клавиатура"""
     keyboard = types.ReplyKeyboardMarkup(resize_keyboard=True, row_width=1)
@@ -108,18 +146,18 @@ def get_reputation_type_keyboard() -> InlineKeyboardMarkup:
     keyboard.add(InlineKeyboardButton("↩️ Назад", callback_data="back_to_profile"))
     return keyboard
 
-def get_reputation_navigation_keyboard(current_index: int, total: int, rep_id: int) -> InlineKeyboardMarkup:
+def get_reputation_navigation_keyboard(current_index: int, total: int) -> InlineKeyboardMarkup:
     """Клавиатура навигации по отзывам"""
     keyboard = InlineKeyboardMarkup(row_width=3)
     
     buttons = []
     if current_index > 0:
-        buttons.append(InlineKeyboardButton("⬅️", callback_data=f"rep_prev_{rep_id}"))
+        buttons.append(InlineKeyboardButton("⬅️", callback_data=rep_cb.new(action="prev", index=current_index - 1)))
     
     buttons.append(InlineKeyboardButton(f"{current_index + 1}/{total}", callback_data="noop"))
     
     if current_index < total - 1:
-        buttons.append(InlineKeyboardButton("➡️", callback_data=f"rep_next_{rep_id}"))
+        buttons.append(InlineKeyboardButton("➡️", callback_data=rep_cb.new(action="next", index=current_index + 1)))
     
     if buttons:
         keyboard.row(*buttons)
@@ -129,22 +167,16 @@ def get_reputation_navigation_keyboard(current_index: int, total: int, rep_id: i
 
 def parse_reputation_command(text: str) -> Optional[tuple]:
     """Парсинг команды репутации"""
-    patterns = [
-        r'^([+-])(rep|реп)\s+(@?\w+|\d+)\s*(.*)$',
-        r'^([+-])(rep|реп)\s+(@?\w+|\d+)$'
-    ]
+    match = _REP_RE.match(text)
+    if not match:
+        return None
     
-    for pattern in patterns:
-        match = re.match(pattern, text, re.IGNORECASE)
-        if match:
-            sign = match.group(1)  # + или -
-            target = match.group(3).lstrip('@')  # username или ID
-            comment = match.group(4) if match.group(4) else ""
-            
-            vote_type = 'positive' if sign == '+' else 'negative'
-            return vote_type, target, comment
+    sign = match.group(1)  # + или -
+    target = match.group(3).lstrip('@')  # username или ID
+    comment = match.group(4) if match.group(4) else ""
     
-    return None
+    vote_type = 'positive' if sign == '+' else 'negative'
+    return vote_type, target, comment
 
 # ========== ОБРАБОТЧИКИ КОМАНД ==========
 @dp.message_handler(commands=['start', 'help'])
@@ -156,7 +188,7 @@ async def cmd_start(message: types.Message):
     last_name = message.from_user.last_name or ""
     
     # Регистрируем/обновляем пользователя
-    db.get_or_create_user(user_id, username, first_name, last_name)
+    await db.get_or_create_user(user_id, username, first_name, last_name)
     
     # Форматированный текст
     text = f"""Репутация — твоя гарантия безопасности.  
@@ -164,7 +196,7 @@ async def cmd_start(message: types.Message):
 
 Здесь можно смотреть и сохранять репутацию, а при сомнениях — провести сделку через автогаранта."""
     
-    await message.answer(text, reply_markup=get_main_keyboard())
+    return await respond(message, text, reply_markup=get_main_keyboard())
 
 @dp.message_handler(lambda message: message.text == "Отправить репутацию")
 async def send_reputation_handler(message: types.Message):
@@ -175,8 +207,8 @@ async def send_reputation_handler(message: types.Message):
 Пример «+rep @username все супер».
 Пример «-rep user_id все супер»."""
     
-    await message.answer(text, reply_markup=get_back_keyboard())
     await ReputationStates.waiting_for_reputation.set()
+    return await respond(message, text, reply_markup=get_back_keyboard())
 
 @dp.message_handler(lambda message: message.text == "Скопировать ID")
 async def copy_id_handler(message: types.Message):
@@ -188,36 +220,34 @@ async def copy_id_handler(message: types.Message):
     keyboard = InlineKeyboardMarkup()
     keyboard.add(InlineKeyboardButton("📋 Скопировать ID", web_app=web_app))
     
-    await message.answer("Нажмите кнопку ниже, чтобы скопировать ваш ID:", reply_markup=keyboard)
+    return await respond(message, "Нажмите кнопку ниже, чтобы скопировать ваш ID:", reply_markup=keyboard)
 
 @dp.message_handler(lambda message: message.text == "Поиск user")
 async def search_user_handler(message: types.Message):
     """Обработчик кнопки 'Поиск user'"""
-    await message.answer(
+    await ReputationStates.waiting_for_search.set()
+    return await respond(
+        message,
         "🔎Отправьте username или ID пользователя,чей профиль хотите найти.",
         reply_markup=get_back_keyboard()
     )
-    await ReputationStates.waiting_for_search.set()
 
 @dp.message_handler(lambda message: message.text == "Профиль")
 async def profile_handler(message: types.Message):
     """Обработчик кнопки 'Профиль'"""
     user_id = message.from_user.id
     
-    # Получаем данные пользователя
-    user_data = db.get_user(user_id)
+    # Получаем данные пользователя вместе со статистикой
+    user_data, stats = await db.get_user_with_stats(user_id)
     if not user_data:
-        await message.answer("Ошибка: пользователь не найден.")
-        return
-    
-    # Получаем статистику
-    stats = db.get_user_stats(user_id)
+        return await respond(message, "Ошибка: пользователь не найден.")
     
     # Форматируем профиль
     profile_text = format_profile(user_data, stats)
     
     # Отправляем с кнопками
-    await message.answer(
+    return await respond(
+        message,
         profile_text,
         parse_mode='HTML',
         reply_markup=get_profile_keyboard(is_own_profile=True)
@@ -227,7 +257,7 @@ async def profile_handler(message: types.Message):
 async def back_handler(message: types.Message, state: FSMContext):
     """Обработчик кнопки 'Назад'"""
     await state.finish()
-    await cmd_start(message)
+    return await cmd_start(message)
 
 # ========== ОБРАБОТКА РЕПУТАЦИИ ==========
 @dp.message_handler(state=ReputationStates.waiting_for_reputation, content_types=['text', 'photo'])
@@ -242,33 +272,29 @@ async def process_reputation(message: types.Message, state: FSMContext):
     text = message.caption if has_photo else message.text
     
     if not text:
-        await message.answer("Пожалуйста, укажите команду репутации.")
-        return
+        return await respond(message, "Пожалуйста, укажите команду репутации.")
     
     # Парсим команду
     parsed = parse_reputation_command(text)
     if not parsed:
-        await message.answer("Неверный формат команды. Используйте: +rep @username [комментарий]")
-        return
+        return await respond(message, "Неверный формат команды. Используйте: +rep @username [комментарий]")
     
     vote_type, target_query, comment = parsed
     
     # Ищем целевого пользователя
-    target_user = db.search_user(target_query)
+    target_user = await db.search_user(target_query)
     if not target_user:
-        await message.answer("❌ Пользователь не найден!")
-        return
+        return await respond(message, "❌ Пользователь не найден!")
     
     # Проверяем наличие фото
     if not has_photo:
-        await message.answer("Ваша репутация не принята! Необходимо приложить фотографию.")
-        return
+        return await respond(message, "Ваша репутация не принята! Необходимо приложить фотографию.")
     
     # Получаем file_id фото (берем самое большое)
     photo_id = message.photo[-1].file_id
     
     # Добавляем репутацию в БД
-    success, msg = db.add_reputation(
+    success, msg = await db.add_reputation(
         from_user_id=user_id,
         to_user_id=target_user['user_id'],
         vote_type=vote_type,
@@ -279,9 +305,9 @@ async def process_reputation(message: types.Message, state: FSMContext):
     if success:
         await message.answer("Репутация сохранена✅")
         await state.finish()
-        await cmd_start(message)
-    else:
-        await message.answer(f"Ошибка: {msg}")
+        return await cmd_start(message)
+    
+    return await respond(message, f"Ошибка: {msg}")
 
 # ========== ПОИСК ПОЛЬЗОВАТЕЛЯ ==========
 @dp.message_handler(state=ReputationStates.waiting_for_search)
@@ -290,13 +316,12 @@ async def process_search(message: types.Message, state: FSMContext):
     query = message.text.strip()
     
     # Ищем пользователя
-    target_user = db.search_user(query)
+    target_user = await db.search_user(query)
     if not target_user:
-        await message.answer("❌Пользователь не найден!")
-        return
+        return await respond(message, "❌Пользователь не найден!")
     
-    # Получаем статистику
-    stats = db.get_user_stats(target_user['user_id'])
+    # Получаем профиль вместе со статистикой
+    target_user, stats = await db.get_user_with_stats(target_user['user_id'])
     
     # Форматируем профиль
     profile_text = format_profile(target_user, stats)
@@ -305,7 +330,8 @@ async def process_search(message: types.Message, state: FSMContext):
     await state.update_data(found_user_id=target_user['user_id'])
     
     # Отправляем профиль с кнопками
-    await message.answer(
+    return await respond(
+        message,
         profile_text,
         parse_mode='HTML',
         reply_markup=get_profile_keyboard(is_own_profile=False)
@@ -317,25 +343,23 @@ async def public_profile_command(message: types.Message):
     """Команда /и или /i для публичного профиля"""
     # Проверяем, что это ответ на сообщение
     if not message.reply_to_message:
-        await message.reply("Пожалуйста, ответьте этой командой на сообщение пользователя.")
-        return
+        return await respond(message, "Пожалуйста, ответьте этой командой на сообщение пользователя.", reply=True)
     
     target_user = message.reply_to_message.from_user
     
-    # Получаем данные из БД
-    user_data = db.get_or_create_user(
+    # Регистрируем пользователя, если его еще нет
+    await db.get_or_create_user(
         target_user.id,
         target_user.username or "",
         target_user.first_name or "",
         target_user.last_name or ""
     )
     
-    if not user_data:
-        await message.reply("❌ Пользователь не найден!")
-        return
+    # Получаем данные из БД вместе со статистикой
+    user_data, stats = await db.get_user_with_stats(target_user.id)
     
-    # Получаем статистику
-    stats = db.get_user_stats(target_user.id)
+    if not user_data:
+        return await respond(message, "❌ Пользователь не найден!", reply=True)
     
     # Форматируем профиль (упрощенный, без кнопок в тексте)
     profile_text = format_profile(user_data, stats)
@@ -345,18 +369,13 @@ async def public_profile_command(message: types.Message):
     keyboard.add(
         InlineKeyboardButton(
             "Перейти в профиль", 
-            url=f"https://t.me/{(await bot.me).username}?start=profile_{target_user.id}"
+            url=f"https://t.me/{BOT_USERNAME}?start=profile_{target_user.id}"
         )
     )
     
-    await message.reply(profile_text, parse_mode='HTML', reply_markup=keyboard)
+    return await respond(message, profile_text, reply=True, parse_mode='HTML', reply_markup=keyboard)
 
-@dp.message_handler(lambda message: message.text and (
-    message.text.startswith('+rep') or 
-    message.text.startswith('-rep') or
-    message.text.startswith('+реп') or 
-    message.text.startswith('-реп')
-))
+@dp.message_handler(regexp=r'^[+-](rep|реп)\b', content_types=['text', 'photo'])
 async def public_reputation_handler(message: types.Message):
     """Обработка репутации в публичных чатах"""
     # Проверяем наличие фото
@@ -373,21 +392,19 @@ async def public_reputation_handler(message: types.Message):
     vote_type, target_query, comment = parsed
     
     # Ищем целевого пользователя
-    target_user = db.search_user(target_query)
+    target_user = await db.search_user(target_query)
     if not target_user:
-        await message.reply("❌ Пользователь не найден!")
-        return
+        return await respond(message, "❌ Пользователь не найден!", reply=True)
     
     # Проверяем наличие фото
     if not has_photo:
-        await message.reply("Ваша репутация не принята! Необходимо приложить фотографию.")
-        return
+        return await respond(message, "Ваша репутация не принята! Необходимо приложить фотографию.", reply=True)
     
     # Получаем file_id фото
     photo_id = message.photo[-1].file_id if message.photo else ""
     
     # Добавляем репутацию
-    success, msg = db.add_reputation(
+    success, msg = await db.add_reputation(
         from_user_id=message.from_user.id,
         to_user_id=target_user['user_id'],
         vote_type=vote_type,
@@ -396,9 +413,9 @@ async def public_reputation_handler(message: types.Message):
     )
     
     if success:
-        await message.reply("Репутация сохранена✅")
-    else:
-        await message.reply(f"Ошибка: {msg}")
+        return await respond(message, "Репутация сохранена✅", reply=True)
+    
+    return await respond(message, f"Ошибка: {msg}", reply=True)
 
 # ========== ОБРАБОТКА CALLBACK-ЗАПРОСОВ ==========
 @dp.callback_query_handler(lambda c: c.data == "my_reputation")
@@ -409,16 +426,15 @@ async def my_reputation_callback(callback_query: types.CallbackQuery):
         reply_markup=get_reputation_type_keyboard()
     )
 
-@dp.callback_query_handler(lambda c: c.data.startswith("rep_"))
-async def reputation_filter_callback(callback_query: types.CallbackQuery):
+@dp.callback_query_handler(lambda c: c.data in ("rep_all", "rep_positive", "rep_negative", "back_to_profile"))
+async def reputation_filter_callback(callback_query: types.CallbackQuery, state: FSMContext):
     """Выбор типа репутации"""
     data = callback_query.data
     
     if data == "back_to_profile":
         # Возврат к профилю
         user_id = callback_query.from_user.id
-        user_data = db.get_user(user_id)
-        stats = db.get_user_stats(user_id)
+        user_data, stats = await db.get_user_with_stats(user_id)
         
         profile_text = format_profile(user_data, stats)
         
@@ -436,30 +452,32 @@ async def reputation_filter_callback(callback_query: types.CallbackQuery):
     elif data == "rep_negative":
         filter_type = 'negative'
     
-    # Получаем отзывы
+    # Получаем только ID отзывов
     user_id = callback_query.from_user.id
-    reputation_list = db.get_user_reputation(user_id, filter_type)
+    rep_ids = await db.get_reputation_ids(user_id, filter_type)
     
-    if not reputation_list:
+    if not rep_ids:
         await callback_query.answer("Нет отзывов выбранного типа", show_alert=True)
         return
     
+    # Запоминаем список и позицию для навигации
+    await state.update_data(rep_ids=rep_ids)
+    
     # Показываем первый отзыв
-    await show_reputation_item(callback_query.message, reputation_list, 0, filter_type)
+    await show_reputation_item(callback_query.message, rep_ids[0], 0, len(rep_ids))
 
-async def show_reputation_item(message: types.Message, rep_list: List[Dict], index: int, filter_type: str):
+async def show_reputation_item(message: types.Message, rep_id: int, index: int, total: int):
     """Показ одного отзыва"""
-    if index < 0 or index >= len(rep_list):
+    rep = await db.get_reputation_by_id(rep_id)
+    if not rep:
         return
     
-    rep = rep_list[index]
-    
     # Формируем текст
     vote_emoji = "✅" if rep['vote_type'] == 'positive' else "❌"
     from_user = f"@{rep['username']}" if rep['username'] else f"ID: {rep['from_user_id']}"
     date = datetime.strptime(rep['created_at'], '%Y-%m-%d %H:%M:%S').strftime('%d.%m.%Y %H:%M')
     
-    text = f"""{vote_emoji} <b>Отзыв {index + 1} из {len(rep_list)}</b>
+    text = f"""{vote_emoji} <b>Отзыв {index + 1} из {total}</b>
 
 От: {from_user}
 Дата: {date}
@@ -467,7 +485,7 @@ async def show_reputation_item(message: types.Message, rep_list: List[Dict], ind
 Комментарий: {rep['comment'] or 'Без комментария'}"""
     
     # Создаем клавиатуру навигации
-    keyboard = get_reputation_navigation_keyboard(index, len(rep_list), rep['id'])
+    keyboard = get_reputation_navigation_keyboard(index, total)
     
     # Отправляем фото с текстом
     await message.answer_photo(
@@ -477,43 +495,25 @@ async def show_reputation_item(message: types.Message, rep_list: List[Dict], ind
         reply_markup=keyboard
     )
 
-@dp.callback_query_handler(lambda c: c.data.startswith("rep_prev_") or c.data.startswith("rep_next_"))
-async def reputation_navigation_callback(callback_query: types.CallbackQuery):
+@dp.callback_query_handler(rep_cb.filter(action=["prev", "next"]))
+async def reputation_navigation_callback(callback_query: types.CallbackQuery, callback_data: dict, state: FSMContext):
     """Навигация по отзывам"""
-    data = callback_query.data
-    
-    # Определяем направление и ID текущего отзыва
-    if data.startswith("rep_prev_"):
-        direction = -1
-        current_rep_id = int(data.split("_")[2])
-    else:
-        direction = 1
-        current_rep_id = int(data.split("_")[2])
+    new_index = int(callback_data["index"])
     
-    # Получаем текущий отзыв
-    current_rep = db.get_reputation_by_id(current_rep_id)
-    if not current_rep:
-        await callback_query.answer("Отзыв не найден", show_alert=True)
-        return
-    
-    # Получаем все отзывы для этого пользователя
-    user_id = current_rep['to_user_id']
-    filter_type = 'all'  # Можно сохранять фильтр в состоянии
-    
-    rep_list = db.get_user_reputation(user_id, filter_type)
-    
-    # Находим текущий индекс
-    current_index = next((i for i, r in enumerate(rep_list) if r['id'] == current_rep_id), -1)
-    if current_index == -1:
+    # Список отзывов хранится в состоянии
+    state_data = await state.get_data()
+    rep_ids = state_data.get('rep_ids')
+    if not rep_ids:
         await callback_query.answer("Ошибка навигации", show_alert=True)
         return
     
-    # Вычисляем новый индекс
-    new_index = current_index + direction
+    if new_index < 0 or new_index >= len(rep_ids):
+        await callback_query.answer()
+        return
     
     # Показываем новый отзыв
     await callback_query.message.delete()  # Удаляем старое сообщение
-    await show_reputation_item(callback_query.message, rep_list, new_index, filter_type)
+    await show_reputation_item(callback_query.message, rep_ids[new_index], new_index, len(rep_ids))
 
 @dp.callback_query_handler(lambda c: c.data == "view_reputation")
 async def view_reputation_callback(callback_query: types.CallbackQuery, state: FSMContext):
@@ -575,10 +575,14 @@ async def copy_id_callback(callback_query: types.CallbackQuery):
 # ========== СТАРТ БОТА ==========
 async def on_startup(dp):
     """Действия при запуске бота"""
+    global BOT_USERNAME
     logger.info("Бот запущен!")
     
-    # Создаем таблицы в БД
-    db.create_tables()
+    # Подключаемся к БД и создаем таблицы
+    await db.connect()
+    
+    # Запоминаем username бота, чтобы не дергать getMe на каждую команду
+    BOT_USERNAME = (await bot.me).username
     
     # Устанавливаем команды бота
     commands = [
@@ -586,18 +590,33 @@ async def on_startup(dp):
         types.BotCommand("help", "Помощь")
     ]
     await bot.set_my_commands(commands)
+    
+    if WEBHOOK_URL:
+        await bot.set_webhook(WEBHOOK_URL, drop_pending_updates=True)
 
 async def on_shutdown(dp):
     """Действия при остановке бота"""
     logger.info("Бот останавливается...")
-    db.close()
+    if WEBHOOK_URL:
+        await bot.delete_webhook()
+    await db.close()
     await dp.storage.close()
     await dp.storage.wait_closed()
 
 if __name__ == '__main__':
-    executor.start_polling(
-        dp, 
-        skip_updates=True,
-        on_startup=on_startup,
-        on_shutdown=on_shutdown
-    )
+    if WEBHOOK_URL:
+        executor.start_webhook(
+            dispatcher=dp,
+            webhook_path=WEBHOOK_PATH,
+            on_startup=on_startup,
+            on_shutdown=on_shutdown,
+            host=WEBAPP_HOST,
+            port=WEBAPP_PORT
+        )
+    else:
+        executor.start_polling(
+            dp, 
+            skip_updates=True,
+            on_startup=on_startup,
+            on_shutdown=on_shutdown
+        )
@@ -1,19 +1,230 @@
+import asyncio
 import sqlite3
 import json
-from datetime import datetime
+from contextlib import asynccontextmanager
+import aiosqlite
+from aiocache import Cache
+from aiocache.serializers import PickleSerializer
+from datetime import datetime, timezone
+from urllib.parse import urlparse
 from typing import Optional, List, Dict, Tuple
 
+def _day_start() -> str:
+    """Начало текущих суток в UTC (в этом формате SQLite хранит created_at)"""
+    return datetime.now(timezone.utc).strftime('%Y-%m-%d 00:00:00')
+
+
+class ReputationBatcher:
+    """Накопление оценок и запись их пачками одной транзакцией"""
+    
+    def __init__(self, conn: aiosqlite.Connection, max_batch_size: int = 50, max_queue_time: float = 0.05):
+        # Собственное соединение: откат пачки не задевает чужие записи
+        self.conn = conn
+        self.max_batch_size = max_batch_size
+        self.max_queue_time = max_queue_time
+        self._queue: List[Tuple[object, asyncio.Future]] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._tasks = set()
+        
+        # Пачки пишутся строго по одной: транзакции на одном соединении не должны пересекаться
+        self._lock = asyncio.Lock()
+        self._flush_scheduled = False
+    
+    async def process(self, item):
+        """Ставит оценку в очередь и ждет результата записи ее пачки"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._queue.append((item, future))
+        
+        if not self._flush_scheduled:
+            if len(self._queue) >= self.max_batch_size:
+                self._schedule_flush()
+            elif self._timer is None:
+                self._timer = loop.call_later(self.max_queue_time, self._schedule_flush)
+        
+        return await future
+    
+    def _schedule_flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        
+        self._flush_scheduled = True
+        task = asyncio.ensure_future(self.flush())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+    
+    async def flush(self):
+        """Запись очередной пачки из очереди"""
+        async with self._lock:
+            self._flush_scheduled = False
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            
+            batch = self._queue[:self.max_batch_size]
+            self._queue = self._queue[self.max_batch_size:]
+            
+            # Остаток очереди пойдет следующей пачкой
+            if self._queue:
+                self._schedule_flush()
+            
+            if not batch:
+                return
+            
+            try:
+                results = await self.process_batch([item for item, _ in batch])
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+            else:
+                for (_, future), result in zip(batch, results):
+                    if not future.done():
+                        future.set_result(result)
+    
+    async def close(self):
+        """Дописывает очередь, дожидается текущих пачек и закрывает соединение"""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        
+        while self._tasks or self._queue:
+            if self._tasks:
+                await asyncio.gather(*self._tasks, return_exceptions=True)
+            else:
+                await self.flush()
+        
+        await self.conn.close()
+    
+    async def process_batch(self, items: List[Tuple]) -> List[bool]:
+        """Запись пачки; False для оценок, уже поставленных сегодня"""
+        today = _day_start()
+        seen = set()
+        results = []
+        
+        try:
+            await self.conn.execute("BEGIN IMMEDIATE")
+            for from_user_id, to_user_id, vote_type, comment, photo_id in items:
+                # Повтор той же пары внутри пачки
+                if (from_user_id, to_user_id) in seen:
+                    results.append(False)
+                    continue
+                seen.add((from_user_id, to_user_id))
+                
+                # Проверка и вставка в одной транзакции
+                async with self.conn.execute('''
+                    INSERT INTO reputation (from_user_id, to_user_id, vote_type, comment, photo_id)
+                    SELECT ?, ?, ?, ?, ?
+                    WHERE NOT EXISTS (
+                        SELECT 1 FROM reputation
+                        WHERE from_user_id = ? AND to_user_id = ?
+                        AND created_at >= ?
+                    )
+                ''', (from_user_id, to_user_id, vote_type, comment, photo_id,
+                      from_user_id, to_user_id, today)) as cursor:
+                    results.append(cursor.rowcount == 1)
+            
+            await self.conn.commit()
+        except Exception:
+            await self.conn.rollback()
+            raise
+        return results
+
+
 class Database:
-    def __init__(self, db_path: str = "reputation.db"):
-        self.conn = sqlite3.connect(db_path, check_same_thread=False)
-        self.conn.row_factory = sqlite3.Row
-        self.create_tables()
+    def __init__(self, db_path: str = "reputation.db", redis_url: Optional[str] = None, readers: int = 4):
+        self.db_path = db_path
+        self.readers = readers
+        
+        # Одно соединение на запись и пул соединений на чтение (WAL позволяет читать параллельно)
+        self.conn: Optional[aiosqlite.Connection] = None
+        self._readers: Optional[asyncio.Queue] = None
+        # Соединение без row_factory для быстрой проверки повторного голоса
+        self._fast_conn: Optional[aiosqlite.Connection] = None
+        self._rep_batcher: Optional[ReputationBatcher] = None
+        
+        # Кэш пользователей, статистики и отзывов (общий для всех процессов, если задан Redis)
+        self.cache = self._make_cache(redis_url)
+    
+    @staticmethod
+    def _make_cache(redis_url: Optional[str]):
+        if not redis_url:
+            # Размер не ограничен: в памяти только записи за последние 60 секунд
+            return Cache(Cache.MEMORY, ttl=60)
+        
+        url = urlparse(redis_url)
+        if url.scheme not in ('redis', 'rediss'):
+            raise ValueError(f"Неподдерживаемая схема REDIS_URL: {url.scheme}")
+        
+        pool_kwargs = {'username': url.username} if url.username else {}
+        return Cache(
+            Cache.REDIS,
+            endpoint=url.hostname or "localhost",
+            port=url.port or 6379,
+            password=url.password,
+            db=int(url.path.lstrip('/') or 0),
+            ssl=url.scheme == 'rediss',
+            connection_pool_kwargs=pool_kwargs,
+            ttl=120,
+            serializer=PickleSerializer()
+        )
     
-    def create_tables(self):
-        cursor = self.conn.cursor()
+    async def connect(self):
+        """Открытие соединений (вызывается в on_startup)"""
+        self.conn = await self._open_connection()
+        await self.create_tables()
+        self._rep_batcher = ReputationBatcher(
+            await self._open_connection(),
+            max_batch_size=50,
+            max_queue_time=0.05
+        )
         
+        self._readers = asyncio.Queue(maxsize=self.readers)
+        for _ in range(self.readers):
+            self._readers.put_nowait(await self._open_connection(small=True))
+        
+        self._fast_conn = await self._open_connection(row_factory=None, small=True)
+    
+    async def _open_connection(self, row_factory=sqlite3.Row, small: bool = False) -> aiosqlite.Connection:
+        """Новое соединение; small — урезанный кэш для вспомогательных соединений на чтение"""
+        conn = await aiosqlite.connect(self.db_path)
+        conn.row_factory = row_factory
+        
+        # Кэш страниц и mmap: 20 МБ / 256 МБ для записи, 2 МБ / 32 МБ для чтения
+        cache_size, mmap_size = (-2000, 33554432) if small else (-20000, 268435456)
+        await conn.executescript(f'''
+            PRAGMA journal_mode=WAL;
+            PRAGMA synchronous=NORMAL;
+            PRAGMA mmap_size={mmap_size};
+            PRAGMA cache_size={cache_size};
+            PRAGMA temp_store=MEMORY;
+        ''')
+        return conn
+    
+    @asynccontextmanager
+    async def _reader(self):
+        """Соединение из пула на чтение"""
+        conn = await self._readers.get()
+        try:
+            yield conn
+        finally:
+            self._readers.put_nowait(conn)
+    
+    async def create_tables(self):
+        # Вся схема, включая заполнение user_stats, создается одной транзакцией:
+        # несколько воркеров могут стартовать одновременно на одной базе
+        await self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            await self._create_schema()
+            await self.conn.commit()
+        except Exception:
+            await self.conn.rollback()
+            raise
+    
+    async def _create_schema(self):
         # Пользователи
-        cursor.execute('''
+        await self.conn.execute('''
             CREATE TABLE IF NOT EXISTS users (
                 user_id INTEGER PRIMARY KEY,
                 username TEXT,
@@ -24,7 +235,7 @@ class Database:
         ''')
         
         # Репутация
-        cursor.execute('''
+        await self.conn.execute('''
             CREATE TABLE IF NOT EXISTS reputation (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
                 from_user_id INTEGER,
@@ -38,106 +249,176 @@ class Database:
             )
         ''')
         
-        # Индексы для быстрого поиска
-        cursor.execute('CREATE INDEX IF NOT EXISTS idx_reputation_to_user ON reputation(to_user_id)')
-        cursor.execute('CREATE INDEX IF NOT EXISTS idx_reputation_from_user ON reputation(from_user_id)')
+        # Счетчики оценок по пользователям (обновляются триггером)
+        async with self.conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'user_stats'"
+        ) as cursor:
+            has_user_stats = await cursor.fetchone() is not None
         
-        self.conn.commit()
+        await self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS user_stats (
+                user_id INTEGER PRIMARY KEY,
+                total INTEGER DEFAULT 0,
+                positive INTEGER DEFAULT 0,
+                negative INTEGER DEFAULT 0
+            )
+        ''')
+        
+        await self.conn.execute('''
+            CREATE TRIGGER IF NOT EXISTS trg_rep_ai AFTER INSERT ON reputation
+            BEGIN
+                INSERT INTO user_stats (user_id, total, positive, negative)
+                VALUES (NEW.to_user_id, 1, NEW.vote_type = 'positive', NEW.vote_type = 'negative')
+                ON CONFLICT(user_id) DO UPDATE SET
+                    total = total + 1,
+                    positive = positive + (NEW.vote_type = 'positive'),
+                    negative = negative + (NEW.vote_type = 'negative');
+            END
+        ''')
+        
+        # Заполняем счетчики по уже существующим оценкам
+        if not has_user_stats:
+            await self.conn.execute('''
+                INSERT INTO user_stats (user_id, total, positive, negative)
+                SELECT 
+                    to_user_id,
+                    COUNT(*),
+                    SUM(CASE WHEN vote_type = 'positive' THEN 1 ELSE 0 END),
+                    SUM(CASE WHEN vote_type = 'negative' THEN 1 ELSE 0 END)
+                FROM reputation
+                GROUP BY to_user_id
+            ''')
+        
+        # Индексы для быстрого поиска
+        await self.conn.execute('CREATE INDEX IF NOT EXISTS idx_reputation_to_user ON reputation(to_user_id)')
+        await self.conn.execute('CREATE INDEX IF NOT EXISTS idx_reputation_from_user ON reputation(from_user_id)')
+        await self.conn.execute('CREATE INDEX IF NOT EXISTS idx_users_username_nocase ON users(LOWER(username))')
+        await self.conn.execute('CREATE INDEX IF NOT EXISTS idx_rep_from_to_date ON reputation(from_user_id, to_user_id, created_at)')
     
     # === Методы для пользователей ===
-    def get_or_create_user(self, user_id: int, username: str = "", first_name: str = "", last_name: str = ""):
-        cursor = self.conn.cursor()
+    async def get_or_create_user(self, user_id: int, username: str = "", first_name: str = "", last_name: str = ""):
+        # Прежний username нужен, чтобы сбросить кэш поиска по нему
+        async with self.conn.execute('SELECT username FROM users WHERE user_id = ?', (user_id,)) as cursor:
+            old = await cursor.fetchone()
         
-        # Проверяем существование
-        cursor.execute('SELECT * FROM users WHERE user_id = ?', (user_id,))
-        user = cursor.fetchone()
+        # Создаем нового или обновляем данные существующего одним запросом
+        async with self.conn.execute('''
+            INSERT INTO users (user_id, username, first_name, last_name)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT(user_id) DO UPDATE SET
+                username = excluded.username,
+                first_name = excluded.first_name,
+                last_name = excluded.last_name
+            RETURNING *
+        ''', (user_id, username, first_name, last_name)) as cursor:
+            user = await cursor.fetchone()
         
-        if not user:
-            # Создаем нового
-            cursor.execute('''
-                INSERT INTO users (user_id, username, first_name, last_name)
-                VALUES (?, ?, ?, ?)
-            ''', (user_id, username, first_name, last_name))
-            self.conn.commit()
-            
-            # Получаем созданного
-            cursor.execute('SELECT * FROM users WHERE user_id = ?', (user_id,))
-            user = cursor.fetchone()
+        await self.conn.commit()
+        await self.cache.delete(f"user:{user_id}")
+        await self.cache.delete(f"search:{username.lower()}")
+        if old and old['username']:
+            await self.cache.delete(f"search:{old['username'].lower()}")
         
         return dict(user) if user else None
     
-    def get_user(self, user_id: int):
-        cursor = self.conn.cursor()
-        cursor.execute('SELECT * FROM users WHERE user_id = ?', (user_id,))
-        user = cursor.fetchone()
-        return dict(user) if user else None
+    async def get_user(self, user_id: int):
+        user = await self.cache.get(f"user:{user_id}")
+        if user is not None:
+            return user
+        
+        async with self._reader() as conn, conn.execute('SELECT * FROM users WHERE user_id = ?', (user_id,)) as cursor:
+            user = await cursor.fetchone()
+        
+        if not user:
+            return None
+        
+        user = dict(user)
+        await self.cache.set(f"user:{user_id}", user)
+        return user
     
-    def search_user(self, query: str):
+    async def search_user(self, query: str):
         """Поиск по username или ID"""
-        cursor = self.conn.cursor()
-        
         # Пробуем как ID
         if query.isdigit():
-            cursor.execute('SELECT * FROM users WHERE user_id = ?', (int(query),))
-            user = cursor.fetchone()
+            user = await self.get_user(int(query))
             if user:
-                return dict(user)
+                return user
         
-        # Пробуем как username (с @ или без)
-        username = query.lstrip('@')
-        cursor.execute('SELECT * FROM users WHERE username LIKE ?', (f"%{username}%",))
-        user = cursor.fetchone()
+        # Пробуем как username (с @ или без), точное совпадение без учета регистра
+        username = query.lstrip('@').lower()
+        user_id = await self.cache.get(f"search:{username}")
+        if user_id is not None:
+            return await self.get_user(user_id)
         
-        return dict(user) if user else None
+        async with self._reader() as conn, conn.execute('SELECT * FROM users WHERE LOWER(username) = ?', (username,)) as cursor:
+            user = await cursor.fetchone()
+        
+        if not user:
+            return None
+        
+        user = dict(user)
+        await self.cache.set(f"search:{username}", user['user_id'])
+        await self.cache.set(f"user:{user['user_id']}", user)
+        return user
     
     # === Методы для репутации ===
-    def add_reputation(self, from_user_id: int, to_user_id: int, vote_type: str, comment: str = "", photo_id: str = ""):
+    async def add_reputation(self, from_user_id: int, to_user_id: int, vote_type: str, comment: str = "", photo_id: str = ""):
         """Добавление оценки репутации"""
-        cursor = self.conn.cursor()
-        
         # Проверка самоголосования
         if from_user_id == to_user_id:
             return False, "Нельзя голосовать за себя"
         
         # Проверка: один голос в день на одного пользователя
-        cursor.execute('''
-            SELECT COUNT(*) FROM reputation 
+        # (быстрый отказ; окончательная проверка идет при записи пачки)
+        today = _day_start()
+        async with self._fast_conn.execute('''
+            SELECT 1 FROM reputation 
             WHERE from_user_id = ? AND to_user_id = ? 
-            AND DATE(created_at) = DATE('now')
-        ''', (from_user_id, to_user_id))
+            AND created_at >= ?
+            LIMIT 1
+        ''', (from_user_id, to_user_id, today)) as cursor:
+            row = await cursor.fetchone()
         
-        if cursor.fetchone()[0] > 0:
+        if row:
             return False, "Вы уже голосовали за этого пользователя сегодня"
         
-        # Добавляем запись
-        cursor.execute('''
-            INSERT INTO reputation (from_user_id, to_user_id, vote_type, comment, photo_id)
-            VALUES (?, ?, ?, ?, ?)
-        ''', (from_user_id, to_user_id, vote_type, comment, photo_id))
+        # Добавляем запись (пишется пачкой вместе с соседними оценками)
+        saved = await self._rep_batcher.process((from_user_id, to_user_id, vote_type, comment, photo_id))
+        if not saved:
+            return False, "Вы уже голосовали за этого пользователя сегодня"
         
-        self.conn.commit()
+        await self.cache.delete(f"stats:{to_user_id}")
         return True, "Репутация сохранена"
     
-    def get_user_stats(self, user_id: int):
-        """Статистика пользователя"""
-        cursor = self.conn.cursor()
+    async def get_user_with_stats(self, user_id: int):
+        """Пользователь и его статистика за один запрос"""
+        user, stats = await self.cache.multi_get([f"user:{user_id}", f"stats:{user_id}"])
+        if user is not None and stats is not None:
+            return user, stats
         
-        # Подсчет оценок
-        cursor.execute('''
-            SELECT 
-                COUNT(*) as total,
-                SUM(CASE WHEN vote_type = 'positive' THEN 1 ELSE 0 END) as positive,
-                SUM(CASE WHEN vote_type = 'negative' THEN 1 ELSE 0 END) as negative
-            FROM reputation 
-            WHERE to_user_id = ?
-        ''', (user_id,))
+        async with self._reader() as conn, conn.execute('''
+            SELECT u.*, s.total, s.positive, s.negative
+            FROM users u
+            LEFT JOIN user_stats s ON s.user_id = u.user_id
+            WHERE u.user_id = ?
+        ''', (user_id,)) as cursor:
+            row = await cursor.fetchone()
         
-        stats = dict(cursor.fetchone())
+        if not row:
+            return None, None
         
-        # Расчет процентов
-        total = stats['total'] or 0
-        positive = stats['positive'] or 0
-        negative = stats['negative'] or 0
+        row = dict(row)
+        stats = self._build_stats(row.pop('total'), row.pop('positive'), row.pop('negative'))
+        
+        await self.cache.multi_set([(f"user:{user_id}", row), (f"stats:{user_id}", stats)])
+        return row, stats
+    
+    @staticmethod
+    def _build_stats(total: Optional[int], positive: Optional[int], negative: Optional[int]) -> Dict:
+        """Расчет процентов по счетчикам оценок"""
+        total = total or 0
+        positive = positive or 0
+        negative = negative or 0
         
         if total > 0:
             pos_percent = round((positive / total) * 100)
@@ -154,40 +435,54 @@ class Database:
             'negative_percent': neg_percent
         }
     
-    def get_user_reputation(self, user_id: int, filter_type: str = 'all'):
-        """Получение отзывов о пользователе"""
-        cursor = self.conn.cursor()
-        
-        query = '''
-            SELECT r.*, u.username, u.first_name, u.last_name
-            FROM reputation r
-            LEFT JOIN users u ON r.from_user_id = u.user_id
-            WHERE r.to_user_id = ?
-        '''
-        
-        params = [user_id]
+    async def get_reputation_ids(self, user_id: int, filter_type: str = 'all') -> List[int]:
+        """ID отзывов о пользователе в порядке показа"""
+        query = 'SELECT r.id FROM reputation r WHERE r.to_user_id = ?' + self._vote_filter(filter_type)
+        query += " ORDER BY r.created_at DESC, r.id DESC"
         
+        async with self._reader() as conn, conn.execute(query, (user_id,)) as cursor:
+            return [row[0] for row in await cursor.fetchall()]
+    
+    @staticmethod
+    def _vote_filter(filter_type: str) -> str:
+        """Условие по типу оценки для запросов к reputation"""
         if filter_type == 'positive':
-            query += " AND r.vote_type = 'positive'"
-        elif filter_type == 'negative':
-            query += " AND r.vote_type = 'negative'"
-        
-        query += " ORDER BY r.created_at DESC"
-        
-        cursor.execute(query, params)
-        return [dict(row) for row in cursor.fetchall()]
+            return " AND r.vote_type = 'positive'"
+        if filter_type == 'negative':
+            return " AND r.vote_type = 'negative'"
+        return ""
     
-    def get_reputation_by_id(self, rep_id: int):
+    async def get_reputation_by_id(self, rep_id: int):
         """Получение конкретного отзыва"""
-        cursor = self.conn.cursor()
-        cursor.execute('''
+        rep = await self.cache.get(f"rep:{rep_id}")
+        if rep is not None:
+            return rep
+        
+        async with self._reader() as conn, conn.execute('''
             SELECT r.*, u.username, u.first_name, u.last_name
             FROM reputation r
             LEFT JOIN users u ON r.from_user_id = u.user_id
             WHERE r.id = ?
-        ''', (rep_id,))
-        rep = cursor.fetchone()
-        return dict(rep) if rep else None
+        ''', (rep_id,)) as cursor:
+            rep = await cursor.fetchone()
+        
+        if not rep:
+            return None
+        
+        rep = dict(rep)
+        await self.cache.set(f"rep:{rep_id}", rep)
+        return rep
     
-    def close(self):
-        self.conn.close()
+    async def close(self):
+        if self._rep_batcher is not None:
+            await self._rep_batcher.close()
+        if self._readers is not None:
+            # Ждем возврата занятых соединений, чтобы закрыть все
+            for _ in range(self.readers):
+                conn = await self._readers.get()
+                await conn.close()
+        if self._fast_conn is not None:
+            await self._fast_conn.close()
+        if self.conn is not None:
+            await self.conn.close()
+        await self.cache.close()
@@ -0,0 +1,165 @@
+import asyncio
+import sqlite3
+
+import pytest
+
+from database import Database
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+async def open_db(tmp_path):
+    db = Database(str(tmp_path / "test.db"))
+    await db.connect()
+    for user_id, username in ((1, "alice"), (2, "bob"), (3, "carol")):
+        await db.get_or_create_user(user_id, username)
+    return db
+
+
+def test_concurrent_votes_for_same_target_saved_once(tmp_path):
+    async def scenario():
+        db = await open_db(tmp_path)
+        try:
+            results = await asyncio.gather(*[
+                db.add_reputation(1, 2, 'positive', "спасибо", "photo")
+                for _ in range(3)
+            ])
+            _, stats = await db.get_user_with_stats(2)
+        finally:
+            await db.close()
+        return results, stats
+
+    results, stats = run(scenario())
+
+    assert [success for success, _ in results].count(True) == 1
+    assert stats['total'] == 1
+
+
+def test_concurrent_votes_for_different_targets_all_saved(tmp_path):
+    async def scenario():
+        db = await open_db(tmp_path)
+        try:
+            return await asyncio.gather(
+                db.add_reputation(1, 2, 'positive'),
+                db.add_reputation(1, 3, 'negative'),
+                db.add_reputation(2, 3, 'positive'),
+            )
+        finally:
+            await db.close()
+
+    results = run(scenario())
+
+    assert all(success for success, _ in results)
+
+
+def test_repeat_vote_rejected_after_flush(tmp_path):
+    async def scenario():
+        db = await open_db(tmp_path)
+        try:
+            first = await db.add_reputation(1, 2, 'positive')
+            second = await db.add_reputation(1, 2, 'negative')
+        finally:
+            await db.close()
+        return first, second
+
+    first, second = run(scenario())
+
+    assert first[0] is True
+    assert second == (False, "Вы уже голосовали за этого пользователя сегодня")
+
+
+def test_search_follows_username_change(tmp_path):
+    async def scenario():
+        db = await open_db(tmp_path)
+        try:
+            assert (await db.search_user("@bob"))['user_id'] == 2
+            await db.get_or_create_user(2, "robert")
+            await db.get_or_create_user(4, "bob")
+            return await db.search_user("bob"), await db.search_user("robert")
+        finally:
+            await db.close()
+
+    bob, robert = run(scenario())
+
+    assert bob['user_id'] == 4
+    assert robert['user_id'] == 2
+
+
+def test_close_waits_for_checked_out_reader(tmp_path):
+    async def scenario():
+        db = await open_db(tmp_path)
+
+        async def slow_read():
+            async with db._reader() as conn:
+                await asyncio.sleep(0.05)
+                return conn
+
+        read = asyncio.create_task(slow_read())
+        await asyncio.sleep(0)
+        await db.close()
+        conn = await read
+
+        with pytest.raises(ValueError):
+            await conn.execute("SELECT 1")
+
+    run(scenario())
+
+
+def test_burst_larger_than_batch_reports_only_stored_votes(tmp_path):
+    async def scenario():
+        db = await open_db(tmp_path)
+        try:
+            # Больше max_batch_size, часть пар повторяется
+            votes = [(voter, target) for voter in range(10, 150) for target in (1, 2, 3)]
+            votes += votes[:60]
+            results = await asyncio.gather(*[
+                db.add_reputation(voter, target, 'positive') for voter, target in votes
+            ], return_exceptions=True)
+        finally:
+            await db.close()
+        return results
+
+    results = run(scenario())
+
+    conn = sqlite3.connect(str(tmp_path / "test.db"))
+    try:
+        stored = conn.execute("SELECT COUNT(*) FROM reputation").fetchone()[0]
+        counted = conn.execute("SELECT SUM(total) FROM user_stats").fetchone()[0]
+    finally:
+        conn.close()
+
+    assert not [r for r in results if isinstance(r, Exception)]
+    saved = [success for success, _ in results].count(True)
+    assert saved == stored == counted == 420
+
+
+def test_concurrent_startup_backfills_user_stats_once(tmp_path):
+    path = str(tmp_path / "test.db")
+    conn = sqlite3.connect(path)
+    conn.executescript('''
+        CREATE TABLE users (user_id INTEGER PRIMARY KEY, username TEXT, first_name TEXT,
+                            last_name TEXT, created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP);
+        CREATE TABLE reputation (id INTEGER PRIMARY KEY AUTOINCREMENT, from_user_id INTEGER,
+                                 to_user_id INTEGER, vote_type TEXT, comment TEXT, photo_id TEXT,
+                                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP);
+        INSERT INTO users (user_id, username) VALUES (2, 'bob');
+        INSERT INTO reputation (from_user_id, to_user_id, vote_type) VALUES (1, 2, 'positive');
+        INSERT INTO reputation (from_user_id, to_user_id, vote_type) VALUES (3, 2, 'negative');
+    ''')
+    conn.close()
+
+    async def scenario():
+        first, second = Database(path), Database(path)
+        try:
+            await asyncio.gather(first.connect(), second.connect())
+            _, stats = await first.get_user_with_stats(2)
+        finally:
+            await first.close()
+            await second.close()
+        return stats
+
+    stats = run(scenario())
+
+    assert (stats['total'], stats['positive'], stats['negative']) == (2, 1, 1)